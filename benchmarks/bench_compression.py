@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Compression benchmark - bandwidth and CPU cost per message.
+
+Encrypts a synthetic corpus of short JSON chat payloads through
+TripleSession without compression, with plain DEFLATE, and with a
+dictionary trained on a separate slice of the corpus.
+"""
+
+import argparse
+import json
+import random
+import time
+
+from ratchet import Compressor, TripleSession, train_dictionary
+
+
+USERS = ["alice", "bob", "carol", "dave", "erin", "frank"]
+ROOMS = ["general", "random", "engineering", "support"]
+TEXTS = [
+    "hey, are you around?",
+    "sounds good to me",
+    "can you take a look at the latest build?",
+    "lunch in 10 minutes",
+    "I'll be a bit late today",
+    "thanks!",
+    "did the deploy go out?",
+    "meeting moved to 3pm",
+]
+
+
+def make_corpus(count: int, seed: int) -> list:
+    """Generate short, repetitive JSON chat messages."""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        message = {
+            "type": "chat.message",
+            "id": f"msg-{rng.randrange(10**8):08d}",
+            "room": rng.choice(ROOMS),
+            "from": rng.choice(USERS),
+            "ts": 1700000000 + i * rng.randrange(1, 60),
+            "body": rng.choice(TEXTS),
+            "reply_to": None if rng.random() < 0.7 else f"msg-{rng.randrange(10**8):08d}",
+        }
+        corpus.append(json.dumps(message, separators=(",", ":")).encode("utf-8"))
+    return corpus
+
+
+def run(name: str, corpus: list, compressor) -> int:
+    """Encrypt and decrypt the corpus, print per-message averages, return wire bytes."""
+    alice = TripleSession(compressor=compressor)
+    bob = TripleSession(compressor=compressor)
+    alice.set_peer_macro_pk(bob.get_macro_pk())
+    bob.set_peer_macro_pk(alice.get_macro_pk())
+
+    plain_bytes = 0
+    cipher_bytes = 0
+    wire_bytes = 0
+    start = time.perf_counter()
+    for message in corpus:
+        ciphertext, header = alice.encrypt(message)
+        assert bob.decrypt(ciphertext, header) == message
+        plain_bytes += len(message)
+        cipher_bytes += len(ciphertext)
+        wire_bytes += len(ciphertext) + len(header)
+    elapsed = time.perf_counter() - start
+
+    n = len(corpus)
+    print(f"{name:<14} {plain_bytes / n:>9.1f} {cipher_bytes / n:>9.1f} "
+          f"{wire_bytes / n:>9.1f} {elapsed / n * 1e6:>10.1f}")
+    return wire_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression benchmark")
+    parser.add_argument("--messages", type=int, default=5000, help="Messages to encrypt")
+    parser.add_argument("--training", type=int, default=1000, help="Messages to train on")
+    parser.add_argument("--dict-size", type=int, default=2048, help="Dictionary size in bytes")
+    args = parser.parse_args()
+
+    samples = make_corpus(args.training, seed=1)
+    corpus = make_corpus(args.messages, seed=2)
+
+    start = time.perf_counter()
+    dictionary = train_dictionary(samples, size=args.dict_size)
+    print(f"Trained {len(dictionary)}-byte dictionary in {time.perf_counter() - start:.2f}s")
+    print()
+
+    print(f"{'mode':<14} {'plain B':>9} {'cipher B':>9} {'wire B':>9} {'us/msg':>10}")
+    baseline = run("none", corpus, None)
+    for name, compressor in (
+        ("zlib", Compressor(min_size=32)),
+        ("zlib+dict", Compressor([dictionary], min_size=32)),
+    ):
+        wire = run(name, corpus, compressor)
+        print(f"{'':<14} saves {100 * (baseline - wire) / baseline:.1f}% on the wire")
+
+
+if __name__ == "__main__":
+    main()
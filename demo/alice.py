@@ -7,7 +7,7 @@ Simple REPL for sending encrypted messages with optional macro rotation.
 
 import sys
 import argparse
-from ratchet import TripleSession
+from ratchet import TripleSession, MacroRatchet
 
 
 def main():
@@ -36,7 +36,7 @@ def main():
         print("✓ Bob's key set")
     except ValueError:
         print("Invalid hex string, using dummy key for demo")
-        session.set_peer_macro_pk(b'\x00' * 32)
+        session.set_peer_macro_pk(MacroRatchet().pk)
     
     print()
     
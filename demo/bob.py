@@ -20,6 +20,15 @@ def main():
     print(f"Current epoch: {session.get_epoch()}")
     print()
     
+    # Get Alice's macro public key
+    print("Enter Alice's macro public key (hex):")
+    try:
+        session.set_peer_macro_pk(bytes.fromhex(input().strip()))
+        print("✓ Alice's key set")
+    except ValueError as e:
+        print(f"Invalid key ({e}); messages from Alice will not authenticate")
+    print()
+    
     while True:
         try:
             print("Paste ciphertext (hex):")
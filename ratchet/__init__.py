@@ -7,6 +7,7 @@ for additional security properties.
 
 from .session import TripleSession
 from .macro_ratchet import MacroRatchet
+from .compression import Compressor, train_dictionary
 
-__all__ = ["TripleSession", "MacroRatchet"]
+__all__ = ["TripleSession", "MacroRatchet", "Compressor", "train_dictionary"]
 __version__ = "0.1.0" 
\ No newline at end of file
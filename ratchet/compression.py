@@ -0,0 +1,231 @@
+"""
+Pre-encryption compression - shrinks small, repetitive payloads.
+
+Uses raw DEFLATE with an optional preset dictionary trained from sample
+traffic. Dictionaries are identified by a hash-derived id carried in the
+message header, so both peers only need to load the same dictionary.
+
+Compressing before encryption leaks information through ciphertext
+length; only enable it for payloads that do not mix secrets with
+attacker-controlled data.
+"""
+
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, Optional, Tuple
+
+import nacl.encoding
+import nacl.hash
+
+
+# Header value for payloads compressed without a preset dictionary
+NO_DICTIONARY = 0
+
+
+def dictionary_id(dictionary: bytes) -> int:
+    """
+    Compute the id that identifies a dictionary on the wire.
+
+    Args:
+        dictionary: Preset dictionary bytes
+
+    Returns:
+        Non-zero 32-bit dictionary id
+    """
+    digest = nacl.hash.generichash(dictionary, digest_size=4, encoder=nacl.encoding.RawEncoder)
+    return int.from_bytes(digest, "big") or 1
+
+
+def _overlap(left: bytes, right: bytes, minimum: int) -> int:
+    """Length of the longest suffix of ``left`` that starts ``right``, or 0."""
+    for length in range(min(len(left), len(right)) - 1, minimum - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+
+def _join(run: bytes, other: bytes, minimum: int) -> Optional[bytes]:
+    """Combine two byte runs that contain or overlap each other, else None."""
+    if other in run:
+        return run
+    if run in other:
+        return other
+    after = _overlap(run, other, minimum)
+    if after:
+        return run + other[after:]
+    before = _overlap(other, run, minimum)
+    if before:
+        return other + run[before:]
+    return None
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = 4096, segment: int = 16) -> bytes:
+    """
+    Build a preset dictionary from sample traffic.
+
+    Picks the byte segments that recur across most samples. Segments that
+    overlap an already chosen run by at least half their length extend
+    that run instead of repeating the shared bytes, so common fields end
+    up as contiguous text. The most common runs go last, where DEFLATE
+    reaches them with the shortest distances.
+
+    Args:
+        samples: Representative plaintext messages
+        size: Maximum dictionary size in bytes
+        segment: Length of the segments counted
+
+    Returns:
+        Dictionary bytes
+    """
+    counts: Counter = Counter()
+    for sample in samples:
+        # Count each segment once per sample so one long message cannot dominate
+        counts.update({
+            sample[i:i + segment]
+            for i in range(max(len(sample) - segment + 1, 1))
+        })
+
+    runs = []
+    used = 0
+    minimum = segment // 2
+    # Sort ties by content so training is reproducible across processes
+    for chunk, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+        if count < 2 or used >= size:
+            break
+        if any(chunk in run for run in runs):
+            continue
+
+        index, merged = len(runs), chunk
+        for i, run in enumerate(runs):
+            merged_run = _join(run, chunk, minimum)
+            if merged_run is not None:
+                index, merged = i, merged_run
+                break
+
+        grown = len(merged) - (len(runs[index]) if index < len(runs) else 0)
+        if used + grown > size:
+            continue
+        if index < len(runs):
+            runs[index] = merged
+        else:
+            runs.append(merged)
+        used += grown
+
+        # A grown run may now overlap another one; fold them together
+        i = 0
+        while i < len(runs):
+            joined = None if i == index else _join(runs[index], runs[i], minimum)
+            if joined is None:
+                i += 1
+                continue
+            used -= len(runs[index]) + len(runs[i]) - len(joined)
+            runs[index] = joined
+            del runs[i]
+            if i < index:
+                index -= 1
+            i = 0
+
+    return b"".join(reversed(runs))
+
+
+class Compressor:
+    """
+    Compresses plaintexts before encryption and bounds decompression.
+
+    Payloads shorter than ``min_size``, or that would not shrink, are left
+    uncompressed. Decompressed output larger than ``max_size`` is rejected.
+    """
+
+    def __init__(self, dictionaries: Iterable[bytes] = (), min_size: int = 64,
+                 max_size: int = 64 * 1024, level: int = 6):
+        """
+        Initialize the compressor.
+
+        Args:
+            dictionaries: Preset dictionaries to accept; the last one is
+                used for compression
+            min_size: Smallest payload worth compressing
+            max_size: Largest allowed decompressed payload
+            level: zlib compression level
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.level = level
+        self.dictionaries: Dict[int, bytes] = {}
+        self.active_id = NO_DICTIONARY
+
+        for dictionary in dictionaries:
+            self.add_dictionary(dictionary)
+
+    def add_dictionary(self, dictionary: bytes) -> int:
+        """
+        Register a dictionary and make it the one used for compression.
+
+        Args:
+            dictionary: Preset dictionary bytes
+
+        Returns:
+            The dictionary's id
+        """
+        dict_id = dictionary_id(dictionary)
+        if self.dictionaries.get(dict_id, dictionary) != dictionary:
+            raise ValueError(f"Dictionary id {dict_id} collides with a loaded dictionary")
+
+        self.dictionaries[dict_id] = dictionary
+        self.active_id = dict_id
+        return dict_id
+
+    def compress(self, data: bytes) -> Tuple[bytes, Optional[int]]:
+        """
+        Compress a payload if it is worth it.
+
+        Args:
+            data: Plaintext to compress
+
+        Returns:
+            Tuple of (payload, dictionary id), with an id of None when the
+            payload was left uncompressed
+        """
+        if len(data) < self.min_size:
+            return data, None
+
+        if self.active_id == NO_DICTIONARY:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                          zdict=self.dictionaries[self.active_id])
+        compressed = compressor.compress(data) + compressor.flush()
+
+        if len(compressed) >= len(data):
+            return data, None
+        return compressed, self.active_id
+
+    def decompress(self, data: bytes, dict_id: int) -> bytes:
+        """
+        Decompress a payload, refusing output beyond ``max_size``.
+
+        Args:
+            data: Compressed payload
+            dict_id: Dictionary id from the message header
+
+        Returns:
+            Decompressed plaintext
+        """
+        if dict_id == NO_DICTIONARY:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif dict_id in self.dictionaries:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.dictionaries[dict_id])
+        else:
+            raise ValueError(f"Unknown compression dictionary id {dict_id}")
+
+        try:
+            plaintext = decompressor.decompress(data, self.max_size + 1)
+        except zlib.error as e:
+            raise ValueError(f"Invalid compressed payload: {e}") from e
+
+        if len(plaintext) > self.max_size:
+            raise ValueError("Decompressed payload exceeds size limit")
+        if not decompressor.eof or decompressor.unused_data:
+            raise ValueError("Invalid compressed payload: truncated or trailing data")
+
+        return plaintext
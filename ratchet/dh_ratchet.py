@@ -10,6 +10,93 @@ from doubleratchet.recommended.diffie_hellman_ratchet_curve25519 import DiffieHe
 from doubleratchet.recommended.aead_aes_hmac import AEAD
 from doubleratchet.recommended.kdf_hkdf import KDF
 from typing import Optional, Tuple
+import os
+import struct
+import weakref
+import nacl.encoding
+import nacl.hash
+import nacl.secret
+import nacl.utils
+
+
+CHAIN_ID_BYTES = 8
+
+# Counter-mode ratchets alive in this process. A forked child inherits
+# their chains, so it must move to fresh ones or it would repeat the
+# parent's next (key, nonce) pairs.
+_counter_ratchets = weakref.WeakSet()
+
+
+def _reseed_counter_chains() -> None:
+    """Give every inherited counter-mode ratchet a new chain after fork."""
+    for ratchet in list(_counter_ratchets):
+        ratchet.start_chain(nacl.utils.random(CHAIN_ID_BYTES))
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed_counter_chains)
+
+
+def derive_chain_key(root_key: bytes, chain_id: bytes) -> bytes:
+    """
+    Derive the secret key of a counter-mode sending chain.
+    
+    Both peers hold the epoch root key, so the receiver recomputes it
+    from the chain id in the header.
+    
+    Args:
+        root_key: Root key of the epoch the chain belongs to
+        chain_id: Identifier of the sending chain
+        
+    Returns:
+        32-byte chain key
+    """
+    return nacl.hash.generichash(
+        chain_id,
+        key=root_key,
+        digest_size=nacl.secret.SecretBox.KEY_SIZE,
+        encoder=nacl.encoding.RawEncoder
+    )
+
+
+def derive_message_key(chain_key: bytes, counter: int) -> bytes:
+    """
+    Derive the key for one message of a sending chain.
+    
+    Args:
+        chain_key: Secret key of the sending chain
+        counter: Message number within the chain
+        
+    Returns:
+        32-byte message key
+    """
+    return nacl.hash.generichash(
+        struct.pack("<Q", counter),
+        key=chain_key,
+        digest_size=nacl.secret.SecretBox.KEY_SIZE,
+        encoder=nacl.encoding.RawEncoder
+    )
+
+
+def derive_nonce(message_key: bytes, epoch: int, chain_id: bytes, counter: int) -> bytes:
+    """
+    Derive a message nonce from its position instead of drawing it at random.
+    
+    Args:
+        message_key: Key the message is encrypted under
+        epoch: Macro epoch of the message
+        chain_id: Identifier of the sending chain
+        counter: Message number within the chain
+        
+    Returns:
+        24-byte SecretBox nonce
+    """
+    return nacl.hash.generichash(
+        struct.pack("<Q8sQ", epoch, chain_id, counter),
+        key=message_key,
+        digest_size=nacl.secret.SecretBox.NONCE_SIZE,
+        encoder=nacl.encoding.RawEncoder
+    )
 
 
 class ConcreteDoubleRatchet(DoubleRatchet):
@@ -20,13 +107,18 @@ class ConcreteDoubleRatchet(DoubleRatchet):
         return b"triple-ratchet-mvp"
 
 
-def create_dh_ratchet(root_key: bytes, peer_pk: Optional[bytes] = None) -> ConcreteDoubleRatchet:
+def create_dh_ratchet(root_key: bytes, peer_pk: Optional[bytes] = None, epoch: int = 0,
+                      counter_nonces: bool = False) -> ConcreteDoubleRatchet:
     """
     Create a DoubleRatchet instance for DH operations.
     
     Args:
         root_key: Root key for the ratchet
         peer_pk: Peer's public key (optional for initiator)
+        epoch: Macro epoch the ratchet belongs to
+        counter_nonces: Derive message keys and nonces from a counter
+            instead of drawing them at random for every message; every
+            ratchet, including a forked child's copy, uses its own chain
         
     Returns:
         ConcreteDoubleRatchet instance
@@ -34,17 +126,32 @@ def create_dh_ratchet(root_key: bytes, peer_pk: Optional[bytes] = None) -> Concr
     # For now, create a simple wrapper that doesn't use the complex doubleratchet library
     # This is a simplified implementation for the MVP
     class SimpleDoubleRatchet:
-        def __init__(self, root_key: bytes, peer_pk: Optional[bytes] = None):
+        def __init__(self, root_key: bytes, peer_pk: Optional[bytes] = None, epoch: int = 0,
+                     counter_nonces: bool = False):
             self.root_key = root_key
             self.sk = None
             self.pk = None
             self.sending_chain = None
             self.receiving_chain = None
+            self.epoch = epoch
+            self.counter_nonces = counter_nonces
+            self.chain_id = None
+            self.chain_key = None
+            self.send_count = 0
+            if counter_nonces:
+                self.start_chain(nacl.utils.random(CHAIN_ID_BYTES))
+                _counter_ratchets.add(self)
+        
+        def start_chain(self, chain_id: bytes) -> None:
+            """Start a new counter-mode sending chain."""
+            self.chain_id = chain_id
+            self.chain_key = derive_chain_key(self.root_key, chain_id)
+            self.send_count = 0
             
         def encrypt(self, plaintext: bytes) -> Tuple[bytes, dict]:
             """Simple encryption for MVP."""
-            import nacl.secret
-            import nacl.utils
+            if self.counter_nonces:
+                return self._encrypt_counter(plaintext)
             
             # Generate a random key for this message
             key = nacl.utils.random(32)
@@ -57,17 +164,43 @@ def create_dh_ratchet(root_key: bytes, peer_pk: Optional[bytes] = None) -> Concr
             }
             
             return ciphertext, header
+        
+        def _encrypt_counter(self, plaintext: bytes) -> Tuple[bytes, dict]:
+            """Encrypt with a counter-derived key and nonce; no RNG calls."""
+            counter = self.send_count
+            self.send_count += 1
+            
+            key = derive_message_key(self.chain_key, counter)
+            nonce = derive_nonce(key, self.epoch, self.chain_id, counter)
+            
+            # Key and nonce are recomputed by the receiver, so only send the
+            # chain position and the MAC + body
+            ciphertext = nacl.secret.SecretBox(key).encrypt(plaintext, nonce).ciphertext
+            
+            header = {
+                "chain": self.chain_id,
+                "n": counter
+            }
+            
+            return ciphertext, header
             
         def decrypt(self, ciphertext: bytes, header: dict) -> bytes:
             """Simple decryption for MVP."""
-            import nacl.secret
+            if "n" in header:
+                chain_id, counter = header.get("chain"), header["n"]
+                if (not isinstance(chain_id, bytes) or len(chain_id) != CHAIN_ID_BYTES
+                        or not isinstance(counter, int) or not 0 <= counter < 2 ** 64):
+                    raise ValueError("Malformed counter-mode header")
+                key = derive_message_key(derive_chain_key(self.root_key, chain_id), counter)
+                nonce = derive_nonce(key, self.epoch, chain_id, counter)
+                return nacl.secret.SecretBox(key).decrypt(ciphertext, nonce)
             
             key = bytes.fromhex(header["key"])
             box = nacl.secret.SecretBox(key)
             
             return box.decrypt(ciphertext)
     
-    return SimpleDoubleRatchet(root_key, peer_pk)
+    return SimpleDoubleRatchet(root_key, peer_pk, epoch, counter_nonces)
 
 
 def dh_ratchet_step(ratchet: DoubleRatchet, peer_pk: bytes) -> bytes:
@@ -4,13 +4,35 @@ Macro ratchet implementation - third layer of the triple ratchet.
 Provides epoch-based rotation of root keys for additional security properties.
 """
 
+import struct
 import time
 from typing import Optional
 import nacl.bindings
+import nacl.encoding
 import nacl.utils
 import nacl.hash
 
 
+KEY_BYTES = nacl.bindings.crypto_scalarmult_SCALARBYTES
+
+
+def check_length(name: str, value: bytes, size: int = KEY_BYTES) -> bytes:
+    """
+    Ensure a key fits a fixed-size record field exactly.
+    
+    Args:
+        name: Field name for the error message
+        value: Key bytes
+        size: Required length
+        
+    Returns:
+        The unchanged value
+    """
+    if not isinstance(value, bytes) or len(value) != size:
+        raise ValueError(f"{name} must be {size} bytes to be stored in a record")
+    return value
+
+
 class MacroRatchet:
     """
     Macro ratchet for epoch-based root key rotation.
@@ -19,6 +41,10 @@ class MacroRatchet:
     intervals or explicit rotation requests.
     """
     
+    # Fixed-size record: root key, previous root flag + value, keypair,
+    # keypair the epoch was entered with, epoch, last reset
+    RECORD = struct.Struct("<32sB32s32s32s32s32sQd")
+    
     def __init__(self, root_key: Optional[bytes] = None):
         """
         Initialize the macro ratchet.
@@ -30,62 +56,185 @@ class MacroRatchet:
             root_key = nacl.utils.random(nacl.bindings.crypto_scalarmult_SCALARBYTES)
         
         self.root_key = root_key
+        self.prev_root_key = None
         self.epoch = 0
         self.last_reset = time.time()
         
         # Generate keypair for this epoch
         self.sk = nacl.utils.random(nacl.bindings.crypto_scalarmult_SCALARBYTES)
         self.pk = nacl.bindings.crypto_scalarmult_base(self.sk)
+        
+        # Keypair held when this epoch began; differs from the current one
+        # only if we entered the epoch by rotating ourselves
+        self.prev_sk = self.sk
+        self.prev_pk = self.pk
+    
+    @staticmethod
+    def _epoch_secret(sk: bytes, root_key: bytes, peer_pk: bytes) -> bytes:
+        """Mix a DH between ``sk`` and ``peer_pk`` into ``root_key``."""
+        try:
+            # Perform DH key exchange
+            shared_secret = nacl.bindings.crypto_scalarmult(sk, peer_pk)
+        except RuntimeError as e:
+            # libsodium rejects low-order points
+            raise ValueError("Invalid peer macro public key") from e
+        
+        # Derive new root key using HKDF-like approach
+        # Use the current root key as salt and shared secret as input
+        return nacl.hash.generichash(
+            shared_secret,
+            key=root_key,
+            digest_size=nacl.bindings.crypto_scalarmult_SCALARBYTES,
+            encoder=nacl.encoding.RawEncoder
+        )
     
     def next_epoch_secret(self, peer_pk: bytes) -> bytes:
         """
         Derive the next epoch's root key using DH with peer's public key.
         
+        The sender calls this with a freshly generated keypair and the
+        receiver with its current one, so both arrive at the same key.
+        
         Args:
             peer_pk: Peer's public key for this epoch
             
         Returns:
             New root key for next epoch
         """
-        try:
-            # Perform DH key exchange
-            shared_secret = nacl.bindings.crypto_scalarmult(self.sk, peer_pk)
-            
-            # Derive new root key using HKDF-like approach
-            # Use the current root key as salt and shared secret as input
-            new_root_key = nacl.hash.generichash(
-                shared_secret,
-                key=self.root_key,
-                digest_size=nacl.bindings.crypto_scalarmult_SCALARBYTES
-            )
+        return self._epoch_secret(self.sk, self.root_key, peer_pk)
+    
+    def crossed_epoch_secret(self, peer_pk: bytes) -> bytes:
+        """
+        Derive the root key of a peer rotation that crossed our own.
+        
+        When both sides rotate out of the same epoch, the peer's new root
+        comes from its new public key and the keypair and root key we held
+        before rotating.
+        
+        Args:
+            peer_pk: Peer's new macro public key
             
-            return new_root_key
-        finally:
-            # PyNaCl does not expose sodium_memzero; skip for compatibility
-            pass
+        Returns:
+            The peer's root key for the current epoch
+        """
+        if self.prev_root_key is None:
+            raise ValueError("No previous epoch to derive a crossed rotation from")
+        return self._epoch_secret(self.prev_sk, self.prev_root_key, peer_pk)
     
-    def rotate(self, peer_pk: bytes) -> None:
+    def bootstrap(self, peer_pk: bytes) -> None:
         """
-        Rotate to the next epoch.
+        Mix the initial macro key exchange into the epoch-0 root key.
         
         Args:
-            peer_pk: Peer's public key for the new epoch
+            peer_pk: Peer's initial macro public key
         """
-        # Derive new root key
-        new_root_key = self.next_epoch_secret(peer_pk)
+        self.root_key = self.next_epoch_secret(peer_pk)
+    
+    def rotate(self, peer_pk: bytes) -> None:
+        """
+        Rotate to the next epoch as the sending side.
         
-        # Zero out old secrets (PyNaCl does not expose sodium_memzero)
-        # nacl.bindings.sodium_memzero(self.root_key)
-        # nacl.bindings.sodium_memzero(self.sk)
+        A fresh keypair is generated first so that the peer can derive the
+        same root key from the new public key and its current secret key.
         
-        # Update state
-        self.root_key = new_root_key
-        self.epoch += 1
-        self.last_reset = time.time()
+        Args:
+            peer_pk: Peer's current macro public key
+        """
+        prev_sk, prev_pk = self.sk, self.pk
         
         # Generate new keypair for this epoch
         self.sk = nacl.utils.random(nacl.bindings.crypto_scalarmult_SCALARBYTES)
         self.pk = nacl.bindings.crypto_scalarmult_base(self.sk)
+        
+        self.advance(self.next_epoch_secret(peer_pk))
+        
+        # Keep the old keypair in case the peer's rotation crossed ours
+        self.prev_sk, self.prev_pk = prev_sk, prev_pk
+    
+    def advance(self, root_key: bytes) -> None:
+        """
+        Enter the next epoch with an already derived root key.
+        
+        Used by the receiving side once a message from the next epoch has
+        authenticated; its own keypair is kept until it rotates itself.
+        
+        Args:
+            root_key: Root key returned by ``next_epoch_secret``
+        """
+        # Update state, keeping the previous root for late messages
+        self.prev_root_key = self.root_key
+        self.root_key = root_key
+        self.epoch += 1
+        self.last_reset = time.time()
+        self.prev_sk, self.prev_pk = self.sk, self.pk
+    
+    def rotated(self) -> bool:
+        """
+        Check whether we entered the current epoch by rotating ourselves.
+        
+        Returns:
+            True if this epoch's keypair was generated by ``rotate``
+        """
+        return self.prev_pk != self.pk
+    
+    def yield_rotation(self, root_key: bytes) -> None:
+        """
+        Give up our rotation into this epoch in favour of the peer's.
+        
+        Restores the keypair held before rotating, since that is the one
+        the peer's rotation was derived against, and takes the peer's root.
+        
+        Args:
+            root_key: Root key returned by ``crossed_epoch_secret``
+        """
+        self.sk, self.pk = self.prev_sk, self.prev_pk
+        self.root_key = root_key
+        self.last_reset = time.time()
+    
+    def to_record(self) -> bytes:
+        """
+        Serialize the ratchet into a fixed-size record.
+        
+        Returns:
+            ``RECORD.size`` bytes
+        """
+        prev_root_key = self.prev_root_key
+        return self.RECORD.pack(
+            check_length("root_key", self.root_key),
+            prev_root_key is not None,
+            b"" if prev_root_key is None else check_length("prev_root_key", prev_root_key),
+            check_length("sk", self.sk),
+            check_length("pk", self.pk),
+            check_length("prev_sk", self.prev_sk),
+            check_length("prev_pk", self.prev_pk),
+            self.epoch,
+            self.last_reset
+        )
+    
+    @classmethod
+    def from_record(cls, record: bytes) -> "MacroRatchet":
+        """
+        Rebuild a ratchet from ``to_record`` output without generating keys.
+        
+        Args:
+            record: Fixed-size record
+            
+        Returns:
+            Restored MacroRatchet
+        """
+        (root_key, has_prev_root, prev_root_key, sk, pk, prev_sk, prev_pk,
+         epoch, last_reset) = cls.RECORD.unpack(record)
+        
+        ratchet = cls.__new__(cls)
+        ratchet.root_key = root_key
+        ratchet.prev_root_key = prev_root_key if has_prev_root else None
+        ratchet.sk = sk
+        ratchet.pk = pk
+        ratchet.prev_sk = prev_sk
+        ratchet.prev_pk = prev_pk
+        ratchet.epoch = epoch
+        ratchet.last_reset = last_reset
+        return ratchet
     
     def due(self, interval_sec: int = 24 * 3600) -> bool:
         """
@@ -106,5 +255,7 @@ class MacroRatchet:
                 nacl.bindings.sodium_memzero(self.root_key)
             if hasattr(self, 'sk'):
                 nacl.bindings.sodium_memzero(self.sk)
+            if hasattr(self, 'prev_sk') and self.prev_sk is not self.sk:
+                nacl.bindings.sodium_memzero(self.prev_sk)
         except:
             pass 
\ No newline at end of file
@@ -5,11 +5,42 @@ Combines macro ratchet, DH ratchet, and symmetric ratchet into a unified
 secure messaging session.
 """
 
+import hashlib
+import hmac
+import struct
+import time
 import msgpack
+import nacl.exceptions
 from typing import Optional, Tuple
-from .macro_ratchet import MacroRatchet
+from .macro_ratchet import MacroRatchet, check_length
 from .dh_ratchet import create_dh_ratchet, dh_ratchet_step, get_dh_keys
 from .symm_ratchet import encrypt_message, decrypt_message
+from .compression import Compressor
+
+
+# Header fields carrying tags; they are left out of the tagged data
+_TAG_FIELDS = ("tag", "ptag")
+TAG_BYTES = 16
+
+
+def _header_tag(root_key: bytes, header: dict, ciphertext: bytes) -> bytes:
+    """Authenticate every header field and the ciphertext under an epoch root key."""
+    # Keyed BLAKE2b, as nacl.hash.generichash, without its per-call overhead
+    auth_key = hashlib.blake2b(b"triple-ratchet-header", key=root_key, digest_size=32).digest()
+    fields = sorted((k, v) for k, v in header.items() if k not in _TAG_FIELDS)
+    return hashlib.blake2b(
+        msgpack.packb(fields) + ciphertext,
+        key=auth_key,
+        digest_size=TAG_BYTES
+    ).digest()
+
+
+def _verify_tag(root_key: Optional[bytes], header: dict, ciphertext: bytes, field: str) -> None:
+    """Check one header tag, raising CryptoError if it is missing or wrong."""
+    tag = header.get(field)
+    if (root_key is None or not isinstance(tag, bytes)
+            or not hmac.compare_digest(tag, _header_tag(root_key, header, ciphertext))):
+        raise nacl.exceptions.CryptoError("Message authentication failed")
 
 
 class TripleSession:
@@ -20,22 +51,52 @@ class TripleSession:
     epoch rotation and chain reset capabilities.
     """
     
-    def __init__(self, root_key: Optional[bytes] = None, peer_pk: Optional[bytes] = None):
+    # Fixed-size record after the macro ratchet's: peer macro pk flag +
+    # value, DH root key, catch-up budget, counter-nonce flag, keyed flag
+    RECORD = struct.Struct("<B32s32sIdddBB")
+    RECORD_SIZE = MacroRatchet.RECORD.size + RECORD.size
+    
+    def __init__(self, root_key: Optional[bytes] = None, peer_pk: Optional[bytes] = None,
+                 catch_up_burst: int = 4, catch_up_refill_sec: float = 60.0,
+                 counter_nonces: bool = False, compressor: Optional[Compressor] = None):
         """
         Initialize a triple ratchet session.
         
         Args:
-            root_key: Initial root key (optional)
+            root_key: Pre-shared root key (optional); mixed with the initial
+                macro key exchange when the peer's key is set
             peer_pk: Peer's public key (optional for initiator)
+            catch_up_burst: Epoch catch-up DH computations allowed back to back
+            catch_up_refill_sec: Seconds to regain one catch-up attempt
+            counter_nonces: Send with counter-derived keys and nonces
+                instead of per-message random ones
+            compressor: Compress plaintexts before encryption and accept
+                compressed messages (optional)
         """
-        # Initialize macro ratchet
-        self.macro_ratchet = MacroRatchet(root_key)
+        # Initialize macro ratchet; without a pre-shared key both peers
+        # start from the same all-zero root before the key exchange, and
+        # the session refuses to run until that exchange has been mixed in
+        self.macro_ratchet = MacroRatchet(root_key if root_key is not None else bytes(32))
+        self.keyed = root_key is not None
+        
+        self.compressor = compressor
         
         # Initialize DH ratchet with macro root key
-        self.dh_ratchet = create_dh_ratchet(self.macro_ratchet.root_key, peer_pk)
+        self.counter_nonces = counter_nonces
+        self.dh_ratchet = create_dh_ratchet(self.macro_ratchet.root_key, peer_pk,
+                                            self.macro_ratchet.epoch, counter_nonces)
         
         # Store peer's macro public key
         self.peer_macro_pk = None
+        
+        # Token bucket limiting catch-up attempts (each one costs a DH)
+        self.catch_up_burst = catch_up_burst
+        self.catch_up_refill_sec = catch_up_refill_sec
+        self._catch_up_tokens = float(catch_up_burst)
+        # Wall-clock time, since the stamp is stored in records that
+        # outlive the process (and the boot)
+        self._catch_up_stamp = time.time()
+        self._catch_up_candidate = None
     
     def encrypt(self, plaintext: bytes, force_rotate: bool = False) -> Tuple[bytes, bytes]:
         """
@@ -48,17 +109,34 @@ class TripleSession:
         Returns:
             Tuple of (ciphertext, serialized_header)
         """
+        self._require_keyed()
+        
         # Check if macro rotation is due or forced
         if force_rotate or self.macro_ratchet.due():
             self._perform_macro_rotation()
         
+        # Compress ahead of the AEAD when configured and worthwhile
+        dict_id = None
+        if self.compressor is not None:
+            plaintext, dict_id = self.compressor.compress(plaintext)
+        
         # Encrypt using DH ratchet
         ciphertext, header = encrypt_message(self.dh_ratchet, plaintext)
+        if dict_id is not None:
+            header["z"] = dict_id
         
         # Add macro ratchet fields to header
         header["epoch"] = self.macro_ratchet.epoch
         header["macro_pk"] = self.macro_ratchet.pk
         
+        # Bind header and ciphertext to this epoch's root key; after a
+        # rotation also tag under the previous root so the peer can vet
+        # the message before paying for the catch-up DH
+        tag = _header_tag(self.macro_ratchet.root_key, header, ciphertext)
+        if self.macro_ratchet.prev_root_key is not None:
+            header["ptag"] = _header_tag(self.macro_ratchet.prev_root_key, header, ciphertext)
+        header["tag"] = tag
+        
         # Serialize header with msgpack
         serialized_header = msgpack.packb(header)
         
@@ -75,15 +153,55 @@ class TripleSession:
         Returns:
             Decrypted plaintext
         """
+        self._require_keyed()
+        
         # Deserialize header
         header = msgpack.unpackb(serialized_header, raw=False)
+        if not isinstance(header, dict) or not all(isinstance(k, str) for k in header):
+            raise ValueError("Malformed message header")
         
-        # Check if we need to catch up on macro rotation
-        if header.get("epoch", 0) > self.macro_ratchet.epoch:
-            self._catch_up_macro_rotation(header)
+        epoch = header.get("epoch", 0)
+        if epoch == self.macro_ratchet.epoch + 1:
+            # Catch up on macro rotation
+            plaintext = self._catch_up_macro_rotation(ciphertext, header)
+        else:
+            if epoch == self.macro_ratchet.epoch:
+                try:
+                    _verify_tag(self.macro_ratchet.root_key, header, ciphertext, "tag")
+                except nacl.exceptions.CryptoError:
+                    if not self.macro_ratchet.rotated():
+                        raise
+                    # The peer may have rotated out of the same epoch as us
+                    plaintext = self._resolve_crossed_rotation(ciphertext, header)
+                    return self._decompress(plaintext, header)
+                dh_ratchet = self.dh_ratchet
+            elif epoch == self.macro_ratchet.epoch - 1:
+                # Late message from before our last rotation
+                _verify_tag(self.macro_ratchet.prev_root_key, header, ciphertext, "tag")
+                # Receive-only ratchet; counter-mode keys derive from that epoch's root
+                dh_ratchet = create_dh_ratchet(self.macro_ratchet.prev_root_key, epoch=epoch)
+            else:
+                raise ValueError(f"Cannot decrypt epoch {epoch} message at epoch {self.macro_ratchet.epoch}")
+            
+            # Decrypt using DH ratchet
+            plaintext = decrypt_message(dh_ratchet, ciphertext, header)
+        
+        return self._decompress(plaintext, header)
+    
+    def _require_keyed(self) -> None:
+        """Refuse to run on the publicly known all-zero root key."""
+        if not self.keyed:
+            raise ValueError("Session has no shared root key; call set_peer_macro_pk "
+                             "or pass a pre-shared root_key")
+    
+    def _decompress(self, plaintext: bytes, header: dict) -> bytes:
+        """Undo compression, only ever called once the message has authenticated."""
+        if "z" in header:
+            if self.compressor is None:
+                raise ValueError("Received compressed message but no compressor is configured")
+            plaintext = self.compressor.decompress(plaintext, header["z"])
         
-        # Decrypt using DH ratchet
-        return decrypt_message(self.dh_ratchet, ciphertext, header)
+        return plaintext
     
     def _perform_macro_rotation(self) -> None:
         """Perform macro rotation and reset DH/symmetric chains."""
@@ -94,35 +212,195 @@ class TripleSession:
         self.macro_ratchet.rotate(self.peer_macro_pk)
         
         # Reset DH ratchet with new root key
-        self.dh_ratchet = create_dh_ratchet(self.macro_ratchet.root_key)
+        self.dh_ratchet = create_dh_ratchet(self.macro_ratchet.root_key, epoch=self.macro_ratchet.epoch,
+                                            counter_nonces=self.counter_nonces)
         
         print(f"Macro rotation performed - new epoch: {self.macro_ratchet.epoch}")
     
-    def _catch_up_macro_rotation(self, header: dict) -> None:
-        """Catch up on macro rotation when receiving from higher epoch."""
+    def _catch_up_macro_rotation(self, ciphertext: bytes, header: dict) -> bytes:
+        """
+        Catch up on macro rotation when receiving from the next epoch.
+        
+        The message must first carry a valid tag under our current root,
+        which costs a hash, so forged packets never reach the DH. The next
+        epoch's root is then derived on the side and only committed once
+        the message also authenticates under it.
+        
+        Args:
+            ciphertext: Encrypted message
+            header: Deserialized message header
+            
+        Returns:
+            Decrypted plaintext
+        """
         peer_macro_pk = header.get("macro_pk")
         if peer_macro_pk is None:
             raise ValueError("Header missing macro_pk for epoch catch-up")
+        if not isinstance(peer_macro_pk, bytes) or len(peer_macro_pk) != len(self.macro_ratchet.pk):
+            raise ValueError("Header macro_pk has invalid length")
         
-        # Store peer's macro public key if not set
-        if self.peer_macro_pk is None:
-            self.peer_macro_pk = peer_macro_pk
+        # Cheap pre-check under the epoch we are in
+        _verify_tag(self.macro_ratchet.root_key, header, ciphertext, "ptag")
         
-        # Rotate macro ratchet to catch up
-        self.macro_ratchet.rotate(peer_macro_pk)
+        # Derive the candidate root once per (epoch, macro_pk)
+        key = (header["epoch"], peer_macro_pk)
+        if self._catch_up_candidate is not None and self._catch_up_candidate[0] == key:
+            candidate_root = self._catch_up_candidate[1]
+        else:
+            self._take_catch_up_token()
+            candidate_root = self.macro_ratchet.next_epoch_secret(peer_macro_pk)
+            self._catch_up_candidate = (key, candidate_root)
         
-        # Reset DH ratchet with new root key
-        self.dh_ratchet = create_dh_ratchet(self.macro_ratchet.root_key)
+        # Raises on authentication failure, leaving the session untouched
+        _verify_tag(candidate_root, header, ciphertext, "tag")
+        candidate_dh = create_dh_ratchet(candidate_root, epoch=header["epoch"],
+                                         counter_nonces=self.counter_nonces)
+        plaintext = decrypt_message(candidate_dh, ciphertext, header)
+        
+        # Authenticated: commit the new epoch and refund the attempt
+        self.macro_ratchet.advance(candidate_root)
+        self.dh_ratchet = candidate_dh
+        self.peer_macro_pk = peer_macro_pk
+        self._catch_up_candidate = None
+        self._catch_up_tokens = min(self._catch_up_tokens + 1, self.catch_up_burst)
         
         print(f"Caught up to epoch {self.macro_ratchet.epoch}")
+        return plaintext
+    
+    def _resolve_crossed_rotation(self, ciphertext: bytes, header: dict) -> bytes:
+        """
+        Handle a peer rotation that left the same epoch as our own.
+        
+        Both sides then sit in the same epoch under different roots. The
+        rotation with the lower macro public key wins: the other side
+        yields, going back to its previous keypair and adopting the
+        winner's root. The winner still reads the loser's messages from
+        the crossed epoch without changing its state.
+        
+        Args:
+            ciphertext: Encrypted message
+            header: Deserialized message header
+            
+        Returns:
+            Decrypted plaintext
+        """
+        peer_macro_pk = header.get("macro_pk")
+        if not isinstance(peer_macro_pk, bytes) or len(peer_macro_pk) != len(self.macro_ratchet.pk):
+            raise ValueError("Header macro_pk has invalid length")
+        
+        # Cheap pre-check: the peer rotated out of the epoch we came from
+        _verify_tag(self.macro_ratchet.prev_root_key, header, ciphertext, "ptag")
+        
+        key = (header["epoch"], peer_macro_pk)
+        if self._catch_up_candidate is not None and self._catch_up_candidate[0] == key:
+            candidate_root = self._catch_up_candidate[1]
+        else:
+            self._take_catch_up_token()
+            candidate_root = self.macro_ratchet.crossed_epoch_secret(peer_macro_pk)
+            self._catch_up_candidate = (key, candidate_root)
+        
+        _verify_tag(candidate_root, header, ciphertext, "tag")
+        candidate_dh = create_dh_ratchet(candidate_root, epoch=header["epoch"],
+                                         counter_nonces=self.counter_nonces)
+        plaintext = decrypt_message(candidate_dh, ciphertext, header)
+        self._catch_up_tokens = min(self._catch_up_tokens + 1, self.catch_up_burst)
+        
+        if peer_macro_pk < self.macro_ratchet.pk:
+            # The peer's rotation wins; ours is dropped
+            self.macro_ratchet.yield_rotation(candidate_root)
+            self.dh_ratchet = candidate_dh
+            self.peer_macro_pk = peer_macro_pk
+            self._catch_up_candidate = None
+            print(f"Yielded crossed rotation in epoch {self.macro_ratchet.epoch}")
+        
+        return plaintext
+    
+    def _take_catch_up_token(self) -> None:
+        """Consume one catch-up DH, refusing once the budget is spent."""
+        now = time.time()
+        # A clock stepped backwards must not drive the budget negative
+        elapsed = max(now - self._catch_up_stamp, 0.0)
+        self._catch_up_tokens = min(
+            self.catch_up_burst,
+            self._catch_up_tokens + elapsed / self.catch_up_refill_sec
+        )
+        self._catch_up_stamp = now
+        
+        if self._catch_up_tokens < 1:
+            raise ValueError("Epoch catch-up rate limit exceeded")
+        self._catch_up_tokens -= 1
+    
+    def to_record(self) -> bytes:
+        """
+        Serialize the session into a fixed-size record.
+        
+        The compressor is configuration rather than state and is not stored.
+        
+        Returns:
+            ``RECORD_SIZE`` bytes
+        """
+        peer_pk = self.peer_macro_pk
+        dh = self.dh_ratchet
+        return self.macro_ratchet.to_record() + self.RECORD.pack(
+            peer_pk is not None,
+            b"" if peer_pk is None else check_length("peer_macro_pk", peer_pk),
+            check_length("dh root_key", dh.root_key),
+            self.catch_up_burst,
+            self.catch_up_refill_sec,
+            self._catch_up_tokens,
+            self._catch_up_stamp,
+            self.counter_nonces,
+            self.keyed
+        )
+    
+    @classmethod
+    def from_record(cls, record: bytes, compressor: Optional[Compressor] = None) -> "TripleSession":
+        """
+        Rebuild a session from ``to_record`` output without generating keys.
+        
+        Args:
+            record: Fixed-size record
+            compressor: Compressor to attach (optional)
+            
+        Returns:
+            Restored TripleSession
+        """
+        split = MacroRatchet.RECORD.size
+        (has_peer_pk, peer_pk, dh_root_key, burst, refill_sec, tokens, stamp,
+         counter_nonces, keyed) = cls.RECORD.unpack(record[split:])
+        
+        session = cls.__new__(cls)
+        session.macro_ratchet = MacroRatchet.from_record(record[:split])
+        session.keyed = bool(keyed)
+        session.compressor = compressor
+        session.counter_nonces = bool(counter_nonces)
+        # Counter mode always starts a fresh random chain: a process that
+        # sent on a loaded record may have died before writing it back
+        session.dh_ratchet = create_dh_ratchet(dh_root_key, epoch=session.macro_ratchet.epoch,
+                                               counter_nonces=session.counter_nonces)
+        session.peer_macro_pk = peer_pk if has_peer_pk else None
+        session.catch_up_burst = burst
+        session.catch_up_refill_sec = refill_sec
+        session._catch_up_tokens = tokens
+        session._catch_up_stamp = stamp
+        session._catch_up_candidate = None
+        return session
     
     def set_peer_macro_pk(self, peer_macro_pk: bytes) -> None:
         """
         Set the peer's macro public key.
         
+        The first key set before any rotation is mixed into the root key,
+        so both peers share it without a pre-shared secret.
+        
         Args:
             peer_macro_pk: Peer's macro public key
         """
+        if self.peer_macro_pk is None and self.macro_ratchet.epoch == 0:
+            self.macro_ratchet.bootstrap(peer_macro_pk)
+            self.dh_ratchet = create_dh_ratchet(self.macro_ratchet.root_key, epoch=0,
+                                                counter_nonces=self.counter_nonces)
+            self.keyed = True
         self.peer_macro_pk = peer_macro_pk
     
     def get_macro_pk(self) -> bytes:
@@ -0,0 +1,173 @@
+"""
+Session table - shares TripleSession state between worker processes.
+
+Stores one fixed-size record per peer in an mmap'd file so that any
+process of a pre-fork server can encrypt or decrypt for any peer.
+Each record is guarded by a POSIX byte-range lock (plus a thread lock
+inside the process), so workers only contend on the same peer.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Union
+
+import nacl.encoding
+import nacl.hash
+
+from .session import TripleSession
+
+
+# Table header: magic, layout version, capacity, record size
+_HEADER = struct.Struct("<8sIII")
+_HEADER_SIZE = 64
+_MAGIC = b"TRIPLERT"
+_VERSION = 7
+
+# Record layout: used flag, peer digest, then TripleSession.to_record()
+_SLOT = struct.Struct("<B32s")
+_RECORD_SIZE = _SLOT.size + TripleSession.RECORD_SIZE
+
+_EMPTY = 0
+_USED = 1
+
+
+def _peer_digest(peer_id: Union[bytes, str]) -> bytes:
+    """Map an arbitrary peer identifier to a fixed 32-byte key."""
+    if isinstance(peer_id, str):
+        peer_id = peer_id.encode("utf-8")
+    return nacl.hash.generichash(peer_id, digest_size=32, encoder=nacl.encoding.RawEncoder)
+
+
+class SessionTable:
+    """
+    Fixed-capacity table of TripleSession records in a shared mmap'd file.
+
+    Peers are placed by hashing their identifier and probing linearly.
+    Records are never evicted, so size ``capacity`` for the expected
+    number of peers. Requires POSIX ``fcntl`` locking.
+    """
+
+    def __init__(self, path: str, capacity: int = 1024, **session_kwargs):
+        """
+        Open or create a session table.
+
+        Args:
+            path: File backing the table; shared by all worker processes
+            capacity: Number of records when creating a new table
+            **session_kwargs: TripleSession options for peers seen the first time
+        """
+        self.path = path
+        self.session_kwargs = session_kwargs
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        # Initialise the header once, serialised across processes
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, _HEADER_SIZE, 0)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, _HEADER_SIZE + capacity * _RECORD_SIZE)
+                os.pwrite(self._fd, _HEADER.pack(_MAGIC, _VERSION, capacity, _RECORD_SIZE), 0)
+            magic, version, capacity, record_size = _HEADER.unpack(
+                os.pread(self._fd, _HEADER.size, 0)
+            )
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, _HEADER_SIZE, 0)
+
+        if magic != _MAGIC or version != _VERSION or record_size != _RECORD_SIZE:
+            os.close(self._fd)
+            raise ValueError(f"{path} is not a compatible session table")
+
+        self.capacity = capacity
+        self._map = mmap.mmap(self._fd, _HEADER_SIZE + capacity * _RECORD_SIZE)
+
+        # fcntl locks are per process; threads also need an in-process lock
+        self._thread_locks: Dict[int, threading.Lock] = {}
+        self._thread_locks_guard = threading.Lock()
+
+    def _offset(self, slot: int) -> int:
+        return _HEADER_SIZE + slot * _RECORD_SIZE
+
+    @contextmanager
+    def _locked(self, slot: int) -> Iterator[None]:
+        """Hold the lock for one record across threads and processes."""
+        with self._thread_locks_guard:
+            thread_lock = self._thread_locks.setdefault(slot, threading.Lock())
+        with thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _RECORD_SIZE, self._offset(slot))
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, _RECORD_SIZE, self._offset(slot))
+
+    @contextmanager
+    def session(self, peer_id: Union[bytes, str]) -> Iterator[TripleSession]:
+        """
+        Lock a peer's record and yield its session.
+
+        A new session is created on first use. Changes made inside the
+        block are written back on exit, including when it raises, since
+        TripleSession only mutates state after a successful operation.
+
+        Args:
+            peer_id: Identifier of the peer
+
+        Yields:
+            The peer's TripleSession
+        """
+        digest = _peer_digest(peer_id)
+        start = int.from_bytes(digest[:8], "little") % self.capacity
+
+        for probe in range(self.capacity):
+            slot = (start + probe) % self.capacity
+            offset = self._offset(slot)
+            with self._locked(slot):
+                record = self._map[offset:offset + _RECORD_SIZE]
+                used, record_digest = _SLOT.unpack_from(record)
+
+                if used == _USED and record_digest != digest:
+                    continue
+
+                if used == _EMPTY:
+                    session = TripleSession(**self.session_kwargs)
+                else:
+                    session = TripleSession.from_record(record[_SLOT.size:],
+                                                        self.session_kwargs.get("compressor"))
+                try:
+                    yield session
+                finally:
+                    # Serialize first so an unstorable session leaves the record intact
+                    packed = _SLOT.pack(_USED, digest) + session.to_record()
+                    self._map[offset:offset + _RECORD_SIZE] = packed
+                return
+
+        raise ValueError("Session table is full")
+
+    def __contains__(self, peer_id: Union[bytes, str]) -> bool:
+        """Check whether a peer already has a record."""
+        digest = _peer_digest(peer_id)
+        start = int.from_bytes(digest[:8], "little") % self.capacity
+
+        for probe in range(self.capacity):
+            slot = (start + probe) % self.capacity
+            offset = self._offset(slot)
+            with self._locked(slot):
+                used, record_digest = _SLOT.unpack_from(self._map, offset)
+                if used == _EMPTY:
+                    return False
+                if record_digest == digest:
+                    return True
+        return False
+
+    def close(self) -> None:
+        """Unmap the table and close its file."""
+        self._map.close()
+        os.close(self._fd)
+
+    def __enter__(self) -> "SessionTable":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
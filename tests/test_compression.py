@@ -0,0 +1,127 @@
+"""
+Unit tests for pre-encryption compression.
+
+Tests dictionary training, size thresholds, and decompression limits.
+"""
+
+import json
+import zlib
+
+import msgpack
+import nacl.utils
+import pytest
+from ratchet import Compressor, TripleSession, train_dictionary
+from ratchet.compression import NO_DICTIONARY, dictionary_id
+
+
+def _chat(i):
+    """Build a short, repetitive JSON chat payload."""
+    return json.dumps({
+        "type": "chat.message",
+        "room": "general",
+        "from": "alice" if i % 2 else "bob",
+        "body": f"message number {i}",
+    }).encode()
+
+
+def _sessions(compressor, bob_compressor=None):
+    alice = TripleSession(compressor=compressor)
+    bob = TripleSession(compressor=bob_compressor or compressor)
+    alice.set_peer_macro_pk(bob.get_macro_pk())
+    bob.set_peer_macro_pk(alice.get_macro_pk())
+    return alice, bob
+
+
+class TestCompression:
+    """Test Compressor and TripleSession compression."""
+
+    def test_train_dictionary(self):
+        """Test that a trained dictionary fits its size and helps compression."""
+        samples = [_chat(i) for i in range(200)]
+        dictionary = train_dictionary(samples, size=512)
+
+        assert 0 < len(dictionary) <= 512
+
+        message = _chat(1000)
+        plain, _ = Compressor(min_size=0).compress(message)
+        trained, dict_id = Compressor([dictionary], min_size=0).compress(message)
+        assert dict_id == dictionary_id(dictionary)
+        assert len(trained) < len(plain)
+
+    def test_trained_dictionary_merges_overlaps(self):
+        """Test that overlapping segments are merged rather than stored shifted copies."""
+        template = b'{"type":"chat.message","room":"general","seq":'
+        samples = [template + b"%d}" % i for i in range(100)]
+
+        dictionary = train_dictionary(samples, size=1024)
+
+        assert dictionary.count(template) == 1
+        assert len(dictionary) < 4 * len(template)
+        assert train_dictionary(reversed(samples), size=1024) == dictionary
+
+    def test_session_roundtrip_with_dictionary(self):
+        """Test that compressed messages round-trip and carry the dictionary id."""
+        dictionary = train_dictionary([_chat(i) for i in range(200)])
+        alice, bob = _sessions(Compressor([dictionary], min_size=16))
+
+        message = _chat(7)
+        ciphertext, header = alice.encrypt(message)
+
+        assert msgpack.unpackb(header, raw=False)["z"] == dictionary_id(dictionary)
+        assert len(ciphertext) < len(message)
+        assert bob.decrypt(ciphertext, header) == message
+
+    def test_compression_flag_is_authenticated(self):
+        """Test that stripping or changing the header's dictionary id is detected."""
+        from nacl.exceptions import CryptoError
+
+        dictionary = train_dictionary([_chat(i) for i in range(200)])
+        alice, bob = _sessions(Compressor([dictionary], min_size=16))
+        ciphertext, header = alice.encrypt(_chat(7))
+
+        fields = msgpack.unpackb(header, raw=False)
+        stripped = dict(fields)
+        del stripped["z"]
+        changed = dict(fields, z=NO_DICTIONARY)
+
+        for tampered in (stripped, changed):
+            with pytest.raises(CryptoError):
+                bob.decrypt(ciphertext, msgpack.packb(tampered))
+
+        assert bob.decrypt(ciphertext, header) == _chat(7)
+
+    def test_small_and_incompressible_payloads_skipped(self):
+        """Test that tiny or incompressible payloads are sent as-is."""
+        alice, bob = _sessions(Compressor(min_size=64))
+
+        for message in (b"hi", nacl.utils.random(256)):
+            ciphertext, header = alice.encrypt(message)
+            assert "z" not in msgpack.unpackb(header, raw=False)
+            assert bob.decrypt(ciphertext, header) == message
+
+    def test_decompression_size_cap(self):
+        """Test that payloads expanding beyond max_size are rejected."""
+        compressor = Compressor(min_size=0, max_size=1024)
+        bomb = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        payload = bomb.compress(b"\x00" * 10**6) + bomb.flush()
+
+        with pytest.raises(ValueError, match="size limit"):
+            compressor.decompress(payload, NO_DICTIONARY)
+
+        # The limit also applies to messages received through a session
+        alice, bob = _sessions(Compressor(min_size=0), compressor)
+        ciphertext, header = alice.encrypt(b"\x00" * 4096)
+        with pytest.raises(ValueError, match="size limit"):
+            bob.decrypt(ciphertext, header)
+
+    def test_unknown_dictionary_rejected(self):
+        """Test that a message using an unloaded dictionary is refused."""
+        alice, bob = _sessions(Compressor([b"chat.message general"], min_size=0), Compressor())
+
+        ciphertext, header = alice.encrypt(_chat(3))
+        with pytest.raises(ValueError, match="Unknown compression dictionary"):
+            bob.decrypt(ciphertext, header)
+
+        bob.compressor = None
+        with pytest.raises(ValueError, match="no compressor"):
+            bob.decrypt(ciphertext, header)
@@ -4,11 +4,28 @@ Unit tests for macro ratchet functionality.
 Tests epoch rotation, catch-up behavior, and root key changes.
 """
 
+import multiprocessing
 import pytest
 import time
 from ratchet import MacroRatchet, TripleSession
 
 
+def _key_nonce(session, header):
+    """Recompute the (message key, nonce) pair a sender just sealed a counter-mode message with."""
+    import msgpack
+    from ratchet.dh_ratchet import derive_chain_key, derive_message_key, derive_nonce
+    
+    fields = msgpack.unpackb(header, raw=False)
+    chain_key = derive_chain_key(session.macro_ratchet.root_key, fields["chain"])
+    key = derive_message_key(chain_key, fields["n"])
+    return key, derive_nonce(key, fields["epoch"], fields["chain"], fields["n"])
+
+
+def _encrypt_in_child(session, queue):
+    """Encrypt one message from a forked copy of a session."""
+    queue.put(_key_nonce(session, session.encrypt(b"from child")[1]))
+
+
 class TestMacroRatchet:
     """Test MacroRatchet class functionality."""
     
@@ -67,7 +84,32 @@ class TestTripleSession:
         assert session.macro_ratchet is not None
         assert session.dh_ratchet is not None
         assert session.get_epoch() == 0
-    
+
+    def test_refuses_unkeyed_session(self):
+        """Test that nothing is sealed or opened under the all-zero root key."""
+        alice = TripleSession()
+        bob = TripleSession()
+
+        with pytest.raises(ValueError, match="no shared root key"):
+            alice.encrypt(b"too early")
+
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        ciphertext, header = alice.encrypt(b"hello")
+        with pytest.raises(ValueError, match="no shared root key"):
+            bob.decrypt(ciphertext, header)
+
+        # The guard survives a stored record
+        with pytest.raises(ValueError, match="no shared root key"):
+            TripleSession.from_record(bob.to_record()).decrypt(ciphertext, header)
+
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        assert bob.decrypt(ciphertext, header) == b"hello"
+
+        # A pre-shared root key is usable straight away
+        shared = bytes(range(32))
+        carol, dave = TripleSession(root_key=shared), TripleSession(root_key=shared)
+        assert dave.decrypt(*carol.encrypt(b"psk")) == b"psk"
+
     def test_encrypt_decrypt_basic(self):
         """Test basic encrypt/decrypt without rotation."""
         alice = TripleSession()
@@ -179,6 +221,335 @@ class TestTripleSession:
             assert alice.get_epoch() == i + 1
             assert bob.get_epoch() == alice.get_epoch()
 
+    
+    def test_forged_catch_up_leaves_state_untouched(self):
+        """Test that a forged higher-epoch packet does not advance the session."""
+        import msgpack
+        from nacl.exceptions import CryptoError
+        
+        alice = TripleSession()
+        bob = TripleSession()
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        
+        ciphertext, header = alice.encrypt(b"genuine", force_rotate=True)
+        
+        # Tamper with the ciphertext so it no longer authenticates
+        forged = ciphertext[:-1] + bytes([ciphertext[-1] ^ 1])
+        
+        bob_root_before = bob.macro_ratchet.root_key
+        bob_dh_before = bob.dh_ratchet
+        with pytest.raises(CryptoError):
+            bob.decrypt(forged, header)
+        
+        assert bob.get_epoch() == 0
+        assert bob.macro_ratchet.root_key == bob_root_before
+        assert bob.dh_ratchet is bob_dh_before
+        
+        # The genuine packet still catches up afterwards
+        assert bob.decrypt(ciphertext, header) == b"genuine"
+        assert bob.get_epoch() == 1
+        
+        # A malformed macro_pk is rejected before any DH
+        bad_header = msgpack.unpackb(header, raw=False)
+        bad_header["epoch"] = 2
+        bad_header["macro_pk"] = b"short"
+        with pytest.raises(ValueError):
+            bob.decrypt(ciphertext, msgpack.packb(bad_header))
+        assert bob.get_epoch() == 1
+    
+    def test_forged_rotation_with_attacker_key(self):
+        """Test that attacker-built rotation packets are rejected without a DH."""
+        import msgpack
+        import nacl.secret
+        import nacl.utils
+        from nacl.exceptions import CryptoError
+        
+        alice = TripleSession()
+        bob = TripleSession()
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        
+        dh_calls = []
+        next_epoch_secret = bob.macro_ratchet.next_epoch_secret
+        bob.macro_ratchet.next_epoch_secret = lambda pk: dh_calls.append(pk) or next_epoch_secret(pk)
+        tokens_before = bob._catch_up_tokens
+        
+        for i in range(20):
+            key = nacl.utils.random(32)
+            ciphertext = nacl.secret.SecretBox(key).encrypt(b"forged")
+            header = {
+                "key": key.hex(),
+                "epoch": bob.get_epoch() + 1,
+                "macro_pk": MacroRatchet().pk,
+            }
+            if i % 2:
+                header["tag"] = nacl.utils.random(16)
+                header["ptag"] = nacl.utils.random(16)
+            with pytest.raises(CryptoError):
+                bob.decrypt(ciphertext, msgpack.packb(header))
+        
+        assert bob.get_epoch() == 0
+        assert dh_calls == []
+        assert bob._catch_up_tokens == tokens_before
+        
+        # A genuine rotation still goes through afterwards
+        ciphertext, header = alice.encrypt(b"genuine", force_rotate=True)
+        assert bob.decrypt(ciphertext, header) == b"genuine"
+        assert bob.get_epoch() == alice.get_epoch() == 1
+        assert len(dh_calls) == 1
+        
+        # Both sides derived the same epoch root
+        assert bob.macro_ratchet.root_key == alice.macro_ratchet.root_key
+    
+    def test_catch_up_rate_limit(self):
+        """Test that catch-up DHs are cached per candidate and rate limited."""
+        import msgpack
+        import nacl.secret
+        import nacl.utils
+        from nacl.exceptions import CryptoError
+        from ratchet.session import _header_tag
+        
+        alice = TripleSession()
+        bob = TripleSession(catch_up_burst=2, catch_up_refill_sec=3600)
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        
+        def pre_checked_packet(macro_pk):
+            """Packet passing the cheap check but failing under the new epoch."""
+            key = nacl.utils.random(32)
+            ciphertext = nacl.secret.SecretBox(key).encrypt(b"bad epoch")
+            header = {"key": key.hex(), "epoch": 1, "macro_pk": macro_pk}
+            header["ptag"] = _header_tag(bob.macro_ratchet.root_key, header, ciphertext)
+            header["tag"] = bytes(16)
+            return ciphertext, msgpack.packb(header)
+        
+        # Repeats of one candidate reuse the cached DH and cost one token
+        repeated = pre_checked_packet(MacroRatchet().pk)
+        for _ in range(3):
+            with pytest.raises(CryptoError):
+                bob.decrypt(*repeated)
+        
+        # A second distinct candidate spends the rest of the budget
+        with pytest.raises(CryptoError):
+            bob.decrypt(*pre_checked_packet(MacroRatchet().pk))
+        
+        ciphertext, header = alice.encrypt(b"genuine", force_rotate=True)
+        with pytest.raises(ValueError, match="rate limit"):
+            bob.decrypt(ciphertext, header)
+        assert bob.get_epoch() == 0
+        
+        # Budget refills over time
+        bob._catch_up_stamp -= 3600
+        assert bob.decrypt(ciphertext, header) == b"genuine"
+        assert bob.get_epoch() == 1
+
+    def test_catch_up_budget_survives_clock_jumps(self):
+        """Test that a stored stamp from a later clock never empties the budget."""
+        alice = TripleSession()
+        bob = TripleSession(catch_up_burst=2, catch_up_refill_sec=60)
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+
+        # A record written under a clock about a month ahead of this one
+        bob._catch_up_stamp = time.time() + 30 * 24 * 3600
+        bob = TripleSession.from_record(bob.to_record())
+
+        assert bob.decrypt(*alice.encrypt(b"rotated", force_rotate=True)) == b"rotated"
+        bob._take_catch_up_token()
+        assert bob._catch_up_tokens >= 0
+
+    @pytest.mark.parametrize("counter_nonces", [False, True])
+    def test_late_message_from_previous_epoch(self, counter_nonces):
+        """Test that a message sent just before a rotation still decrypts."""
+        alice = TripleSession(counter_nonces=counter_nonces)
+        bob = TripleSession(counter_nonces=counter_nonces)
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        
+        late = alice.encrypt(b"before rotation")
+        rotated = alice.encrypt(b"after rotation", force_rotate=True)
+        
+        assert bob.decrypt(*rotated) == b"after rotation"
+        assert bob.decrypt(*late) == b"before rotation"
+    
+    def test_epoch_gap_rejected(self):
+        """Test that skipping an epoch is refused instead of desyncing."""
+        alice = TripleSession()
+        bob = TripleSession()
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        
+        alice.encrypt(b"lost", force_rotate=True)
+        ciphertext, header = alice.encrypt(b"too far", force_rotate=True)
+        
+        with pytest.raises(ValueError, match="Cannot decrypt epoch"):
+            bob.decrypt(ciphertext, header)
+        assert bob.get_epoch() == 0
+
+    def _check_crossed(self, alice, bob, alice_sent, bob_sent, deliver_to_bob_first, old_pks):
+        """Deliver two crossed rotation messages and check both sides converge."""
+        new_pks = {alice: alice.get_macro_pk(), bob: bob.get_macro_pk()}
+        if deliver_to_bob_first:
+            assert bob.decrypt(*alice_sent) == b"from alice"
+            assert alice.decrypt(*bob_sent) == b"from bob"
+        else:
+            assert alice.decrypt(*bob_sent) == b"from bob"
+            assert bob.decrypt(*alice_sent) == b"from alice"
+
+        assert alice.get_epoch() == bob.get_epoch() == 1
+        assert alice.macro_ratchet.root_key == bob.macro_ratchet.root_key
+
+        # The rotation with the lower public key won; the other side went
+        # back to its old keypair
+        winner = min(new_pks, key=new_pks.get)
+        loser = bob if winner is alice else alice
+        assert winner.get_macro_pk() == new_pks[winner]
+        assert loser.get_macro_pk() == old_pks[loser]
+        assert not loser.macro_ratchet.rotated()
+
+        # Traffic flows both ways afterwards, including a further rotation
+        for _ in range(2):
+            assert bob.decrypt(*alice.encrypt(b"a")) == b"a"
+            assert alice.decrypt(*bob.encrypt(b"b")) == b"b"
+        assert alice.decrypt(*bob.encrypt(b"next", force_rotate=True)) == b"next"
+        assert bob.decrypt(*alice.encrypt(b"reply")) == b"reply"
+        assert alice.get_epoch() == bob.get_epoch() == 2
+
+    @pytest.mark.parametrize("deliver_to_bob_first", [True, False])
+    def test_crossed_forced_rotations(self, deliver_to_bob_first):
+        """Test that rotations crossing in flight resolve to one shared root."""
+        alice = TripleSession()
+        bob = TripleSession()
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        old_pks = {alice: alice.get_macro_pk(), bob: bob.get_macro_pk()}
+
+        alice_sent = alice.encrypt(b"from alice", force_rotate=True)
+        bob_sent = bob.encrypt(b"from bob", force_rotate=True)
+        assert alice.macro_ratchet.root_key != bob.macro_ratchet.root_key
+
+        # The keypair needed to yield survives a stored record
+        restored = TripleSession.from_record(alice.to_record())
+        old_pks[restored] = old_pks.pop(alice)
+        alice = restored
+
+        self._check_crossed(alice, bob, alice_sent, bob_sent, deliver_to_bob_first, old_pks)
+
+    def test_both_sides_due(self):
+        """Test that both peers rotating on the interval at once stay in sync."""
+        alice = TripleSession()
+        bob = TripleSession()
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        old_pks = {alice: alice.get_macro_pk(), bob: bob.get_macro_pk()}
+
+        alice.macro_ratchet.last_reset -= 25 * 3600
+        bob.macro_ratchet.last_reset -= 25 * 3600
+        alice_sent = alice.encrypt(b"from alice")
+        bob_sent = bob.encrypt(b"from bob")
+        assert alice.get_epoch() == bob.get_epoch() == 1
+
+        self._check_crossed(alice, bob, alice_sent, bob_sent, True, old_pks)
+        assert not alice.macro_ratchet.due() and not bob.macro_ratchet.due()
+
+    def test_crossed_rotation_loser_messages_readable(self):
+        """Test that the winner still reads every message the loser sent before yielding."""
+        alice = TripleSession()
+        bob = TripleSession()
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+
+        alice_sent = [alice.encrypt(b"a%d" % i, force_rotate=(i == 0)) for i in range(3)]
+        bob_sent = [bob.encrypt(b"b%d" % i, force_rotate=(i == 0)) for i in range(3)]
+        if alice.get_macro_pk() < bob.get_macro_pk():
+            winner, loser, loser_sent = alice, bob, bob_sent
+        else:
+            winner, loser, loser_sent = bob, alice, alice_sent
+        winner_root = winner.macro_ratchet.root_key
+
+        for i, message in enumerate(loser_sent):
+            assert winner.decrypt(*message) == (b"a%d" if loser is alice else b"b%d") % i
+        assert winner.macro_ratchet.root_key == winner_root
+        assert winner.macro_ratchet.rotated()
+
+    def test_counter_nonces(self):
+        """Test counter-derived nonces round-trip and never repeat across rotations."""
+        import msgpack
+        
+        alice = TripleSession(counter_nonces=True)
+        bob = TripleSession()
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        
+        pairs = set()
+        counters = set()
+        sent = 0
+        for epoch in range(4):
+            for i in range(5):
+                message = f"Message {epoch}.{i}".encode()
+                ciphertext, header = alice.encrypt(message, force_rotate=(i == 0 and epoch > 0))
+                
+                # No nonce prefix: only the 16-byte MAC is added
+                assert len(ciphertext) == len(message) + 16
+                assert bob.decrypt(ciphertext, header) == message
+                
+                # The receiver derives the key; it never travels
+                fields = msgpack.unpackb(header, raw=False)
+                assert fields["epoch"] == epoch
+                assert "key" not in fields
+                pairs.add(_key_nonce(alice, header))
+                counters.add(fields["n"])
+                sent += 1
+        
+        # Counters restart with every chain, yet no (key, nonce) pair repeats
+        assert len(counters) < sent
+        assert len(pairs) == sent
+        assert bob.get_epoch() == alice.get_epoch() == 3
+    
+    def test_counter_nonces_after_fork(self):
+        """Test that a forked child never repeats the parent's (key, nonce) pairs."""
+        alice = TripleSession(counter_nonces=True)
+        bob = TripleSession()
+        alice.set_peer_macro_pk(bob.get_macro_pk())
+        bob.set_peer_macro_pk(alice.get_macro_pk())
+        alice.encrypt(b"before fork")
+        
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        children = [ctx.Process(target=_encrypt_in_child, args=(alice, queue)) for _ in range(3)]
+        for child in children:
+            child.start()
+        pairs = [queue.get(timeout=10) for _ in children]
+        for child in children:
+            child.join(timeout=10)
+        
+        # The parent's next message uses the counter every child inherited
+        ciphertext, header = alice.encrypt(b"from parent")
+        pairs.append(_key_nonce(alice, header))
+        
+        assert len(set(pairs)) == len(pairs)
+        assert bob.decrypt(ciphertext, header) == b"from parent"
+    
+    def test_counter_nonces_counter_advances(self):
+        """Test that the sending counter increases and restarts with each chain."""
+        import msgpack
+        
+        alice = TripleSession(counter_nonces=True)
+        alice.set_peer_macro_pk(TripleSession().get_macro_pk())
+        
+        packed = [alice.encrypt(b"x")[1] for _ in range(3)]
+        keys = {_key_nonce(alice, header)[0] for header in packed}
+        headers = [msgpack.unpackb(header, raw=False) for header in packed]
+        assert [h["n"] for h in headers] == [0, 1, 2]
+        assert len(keys) == 3
+        
+        packed_rotated = alice.encrypt(b"x", force_rotate=True)[1]
+        rotated = msgpack.unpackb(packed_rotated, raw=False)
+        assert rotated["n"] == 0
+        assert rotated["chain"] != headers[0]["chain"]
+        assert _key_nonce(alice, packed_rotated)[0] not in keys
+
 
 if __name__ == "__main__":
     pytest.main([__file__]) 
\ No newline at end of file
@@ -0,0 +1,184 @@
+"""
+Unit tests for the shared session table.
+
+Tests record persistence, cross-process sharing, and capacity limits.
+"""
+
+import multiprocessing
+import os
+
+import pytest
+from ratchet import TripleSession
+from ratchet.session_table import SessionTable
+
+
+def _decrypt_in_worker(path, ciphertext, header, queue):
+    """Decrypt a message for alice from a separate worker process."""
+    with SessionTable(path) as table:
+        with table.session("alice") as session:
+            queue.put((session.decrypt(ciphertext, header), session.get_epoch()))
+
+
+def _rotate_many_in_worker(path, count, queue):
+    """Rotate bob's session several times, reopening the record each time."""
+    import msgpack
+
+    with SessionTable(path) as table:
+        for i in range(count):
+            with table.session("bob") as alice:
+                header = msgpack.unpackb(alice.encrypt(b"hi", force_rotate=True)[1], raw=False)
+                queue.put(header["epoch"])
+
+
+def _encrypt_and_crash_in_worker(path, queue):
+    """Send one counter-mode message for bob, then die before the write-back."""
+    import msgpack
+
+    with SessionTable(path) as table:
+        with table.session("bob") as alice:
+            header = msgpack.unpackb(alice.encrypt(b"lost")[1], raw=False)
+            queue.put((header["chain"], header["n"]))
+            queue.close()
+            queue.join_thread()
+            os._exit(0)
+
+
+class TestSessionTable:
+    """Test SessionTable functionality."""
+
+    def test_session_persists_between_opens(self, tmp_path):
+        """Test that session state survives closing and reopening the table."""
+        path = str(tmp_path / "sessions.tbl")
+        alice = TripleSession()
+
+        with SessionTable(path, capacity=8) as table:
+            assert "alice" not in table
+            with table.session("alice") as bob:
+                bob.set_peer_macro_pk(alice.get_macro_pk())
+                alice.set_peer_macro_pk(bob.get_macro_pk())
+                bob_pk = bob.get_macro_pk()
+            assert "alice" in table
+
+        ciphertext, header = alice.encrypt(b"rotated", force_rotate=True)
+
+        with SessionTable(path) as table:
+            assert table.capacity == 8
+            with table.session("alice") as bob:
+                assert bob.get_macro_pk() == bob_pk
+                assert bob.decrypt(ciphertext, header) == b"rotated"
+                bob_root = bob.macro_ratchet.root_key
+            with table.session("alice") as bob:
+                assert bob.get_epoch() == 1
+                assert bob.macro_ratchet.root_key == bob_root
+
+    def test_shared_between_processes(self, tmp_path):
+        """Test that a worker's catch-up is visible to other workers."""
+        path = str(tmp_path / "sessions.tbl")
+        alice = TripleSession()
+
+        with SessionTable(path) as table:
+            with table.session("alice") as bob:
+                bob.set_peer_macro_pk(alice.get_macro_pk())
+                alice.set_peer_macro_pk(bob.get_macro_pk())
+
+        ciphertext1, header1 = alice.encrypt(b"first", force_rotate=True)
+        ciphertext2, header2 = alice.encrypt(b"second")
+
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        worker = ctx.Process(target=_decrypt_in_worker, args=(path, ciphertext1, header1, queue))
+        worker.start()
+        plaintext, epoch = queue.get(timeout=10)
+        worker.join(timeout=10)
+
+        assert plaintext == b"first"
+        assert epoch == 1
+
+        # This process picks up the epoch the worker committed
+        with SessionTable(path) as table:
+            with table.session("alice") as bob:
+                assert bob.get_epoch() == 1
+                assert bob.decrypt(ciphertext2, header2) == b"second"
+
+    def test_incompatible_file_rejected(self, tmp_path):
+        """Test that a foreign file is not treated as a session table."""
+        path = tmp_path / "not-a-table"
+        path.write_bytes(b"\x00" * 128)
+
+        with pytest.raises(ValueError):
+            SessionTable(str(path))
+
+    def test_table_full(self, tmp_path):
+        """Test that the table refuses peers beyond its capacity."""
+        with SessionTable(str(tmp_path / "sessions.tbl"), capacity=2) as table:
+            for peer in ("p1", "p2"):
+                with table.session(peer):
+                    pass
+
+            with pytest.raises(ValueError, match="full"):
+                with table.session("p3"):
+                    pass
+
+    def test_counter_chain_not_reused_after_crash(self, tmp_path):
+        """Test that a record used but never written back does not repeat a counter."""
+        import msgpack
+
+        path = str(tmp_path / "sessions.tbl")
+
+        with SessionTable(path, counter_nonces=True) as table:
+            with table.session("bob") as alice:
+                alice.set_peer_macro_pk(TripleSession().get_macro_pk())
+
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        worker = ctx.Process(target=_encrypt_and_crash_in_worker, args=(path, queue))
+        worker.start()
+        crashed = queue.get(timeout=10)
+        worker.join(timeout=10)
+
+        with SessionTable(path) as table:
+            with table.session("bob") as alice:
+                assert alice.counter_nonces
+                header = msgpack.unpackb(alice.encrypt(b"next")[1], raw=False)
+
+        assert header["chain"] != crashed[0]
+
+    def test_concurrent_workers_share_one_record(self, tmp_path):
+        """Test that workers mutating one record at once never lose updates."""
+        path = str(tmp_path / "sessions.tbl")
+        workers, count = 4, 25
+
+        with SessionTable(path) as table:
+            with table.session("bob") as alice:
+                alice.set_peer_macro_pk(TripleSession().get_macro_pk())
+
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        processes = [
+            ctx.Process(target=_rotate_many_in_worker, args=(path, count, queue))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        epochs = [queue.get(timeout=30) for _ in range(workers * count)]
+        for process in processes:
+            process.join(timeout=30)
+            assert process.exitcode == 0
+
+        # Every rotation started from the epoch the previous one stored
+        assert sorted(epochs) == list(range(1, workers * count + 1))
+
+        with SessionTable(path) as table:
+            with table.session("bob") as alice:
+                assert alice.get_epoch() == workers * count
+
+    def test_wrong_key_length_rejected(self, tmp_path):
+        """Test that keys that do not fit a record raise instead of being padded."""
+        with SessionTable(str(tmp_path / "sessions.tbl")) as table:
+            with pytest.raises(ValueError, match="32 bytes"):
+                with table.session("short") as session:
+                    session.macro_ratchet.root_key = b"k" * 16
+            assert "short" not in table
+
+            with pytest.raises(ValueError, match="32 bytes"):
+                TripleSession(root_key=b"k" * 16).to_record()